@@ -1,36 +1,57 @@
 import botocore
 import botocore.exceptions
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import locale
-import json
+import functools
+import logging
 from pkg_resources import resource_filename
-import re
 import scrape
-import traceback
+import simdjson
+import threading
+
+log = logging.getLogger(__name__)
+
+# Reused for every PriceList offer. Documents are parsed lazily, so only the
+# keys we actually read get converted to Python objects, and the parser reuses
+# its internal buffer, so memory stays bounded by the largest single offer no
+# matter how many pages are fetched. Proxies from one offer must be released
+# before the next parse, so the per-offer functions below only use them for
+# early-exit checks and hand plain dicts and strings to everything else.
+# Not thread-safe.
+_PARSER = simdjson.Parser()
+
+# Translations between the API and what is used locally
+_OS_MAP = {'Linux': 'linux',
+           'RHEL': 'rhel',
+           'Red Hat Enterprise Linux with HA': 'rhel',
+           'SUSE': 'sles',
+           'Windows': 'mswin',
+           # Spot products
+           'Linux/UNIX': 'linux',
+           'Red Hat Enterprise Linux': 'rhel',
+           'SUSE Linux': 'sles'}
+_SW_MAP = {'NA': '',
+           'SQL Std': 'SQL',
+           'SQL Web': 'SQLWeb',
+           'SQL Ent': 'SQLEnterprise'}
+_LEASE_MAP = {'1yr': 'yrTerm1',
+              '3yr': 'yrTerm3'}
+_OPT_MAP = {'All Upfront': 'allUpfront',
+            'Partial Upfront': 'partialUpfront',
+            'No Upfront': 'noUpfront'}
+
 
 def canonicalize_location(location):
     """Ensure location aligns with one of the options returned by get_region_descriptions()"""
     # The pricing API returns locations with the old EU prefix
-    return re.sub("^EU", "Europe", location)
+    return 'Europe' + location[2:] if location.startswith('EU') else location
 
 
 # Translate between the API and what is used locally
+@functools.lru_cache(maxsize=64)
 def translate_platform_name(operating_system, preinstalled_software):
-    os = {'Linux': 'linux',
-          'RHEL': 'rhel',
-          'Red Hat Enterprise Linux with HA': 'rhel',
-          'SUSE': 'sles',
-          'Windows': 'mswin',
-          # Spot products
-          'Linux/UNIX': 'linux',
-          'Red Hat Enterprise Linux': 'rhel',
-          'SUSE Linux': 'sles'}
-    software = {'NA': '',
-          'SQL Std': 'SQL',
-          'SQL Web': 'SQLWeb',
-          'SQL Ent': 'SQLEnterprise'}
-    return os[operating_system] + software[preinstalled_software]
+    return _OS_MAP[operating_system] + _SW_MAP[preinstalled_software]
 
 
 # Translate between the API and what is used locally
@@ -38,32 +59,38 @@ def translate_reserved_terms(term_attributes):
     lease_contract_length = term_attributes.get('LeaseContractLength')
     purchase_option = term_attributes.get('PurchaseOption')
     offering_class = term_attributes.get('OfferingClass')
-    leases = {'1yr': 'yrTerm1',
-              '3yr': 'yrTerm3'}
-    options = {'All Upfront': 'allUpfront',
-               'Partial Upfront': 'partialUpfront',
-               'No Upfront': 'noUpfront'}
-    return leases[lease_contract_length] + str(offering_class).capitalize() + '.' + options[purchase_option]
+    return _reserved_term_name(lease_contract_length, purchase_option, offering_class)
+
+
+# Only a handful of combinations exist, term_attributes itself is not hashable
+@functools.lru_cache(maxsize=64)
+def _reserved_term_name(lease_contract_length, purchase_option, offering_class):
+    return _LEASE_MAP[lease_contract_length] + str(offering_class).capitalize() + '.' + _OPT_MAP[purchase_option]
 
 
 # The pricing API requires human readable names for some reason
+@functools.lru_cache(maxsize=1)
 def get_region_descriptions():
     result = dict()
     # Source: https://github.com/boto/botocore/blob/develop/botocore/data/endpoints.json
     endpoint_file = resource_filename('botocore', 'data/endpoints.json')
-    with open(endpoint_file, 'r') as f:
-        endpoints = json.load(f)
-        for partition in endpoints['partitions']:
-            for region in partition['regions']:
-                result[partition['regions'][region]['description']] = region
+    # Only region descriptions are needed, a lazy parse skips building the
+    # much larger services section. A separate parser keeps this independent
+    # of any offer proxies still held from _PARSER.
+    endpoints = simdjson.Parser().load(endpoint_file)
+    for partition in endpoints['partitions']:
+        regions = partition['regions']
+        for region in regions:
+            result[regions[region]['description']] = region
 
     return result
 
 
-def get_instances():
+def _collect_instance_types():
     instance_types = {}
     try:
-        ec2_client = boto3.client('ec2', region_name='us-east-1')
+        # runs in a worker thread, so use its own session rather than boto3's default one
+        ec2_client = boto3.Session().client('ec2', region_name='us-east-1')
         ec2_pager = ec2_client.get_paginator('describe_instance_types')
         instance_type_iterator = ec2_pager.paginate()
         for result in instance_type_iterator:
@@ -72,7 +99,10 @@ def get_instances():
     except botocore.exceptions.ClientError as e:
         print(f"ERROR: Failure listing EC2 instance types. See README for proper IAM permissions.\n{e}")
         raise e
+    return instance_types
 
+
+def get_instances():
     instances = {}
     pricing_client = boto3.client('pricing', region_name='us-east-1')
     product_pager = pricing_client.get_paginator('get_products')
@@ -82,35 +112,53 @@ def get_instances():
             # We're gonna assume N. Virginia has all the available types
             {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': 'US East (N. Virginia)'},
 
-        ]
+        ],
+        PaginationConfig={'PageSize': 100}
     )
-    for product_item in product_iterator:
-        for offer_string in product_item.get('PriceList'):
-            offer = json.loads(offer_string)
-            product = offer.get('product')
+    # listing instance types and products are independent, overlap the two
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        instance_types_future = executor.submit(_collect_instance_types)
+        for product_item in product_iterator:
+            # only blocks until the instance types have been listed
+            instance_types = instance_types_future.result()
+            for offer_string in product_item.get('PriceList'):
+                add_instance(instances, offer_string, instance_types)
+        # surface a listing failure even if there were no product pages
+        instance_types_future.result()
 
-            # Check if it's an instance
-            if product.get('productFamily') not in ['Compute Instance', 'Compute Instance (bare metal)', 'Dedicated Host']:
-                continue
+    print(f"Found data for instance types: {', '.join(sorted(instances.keys()))}")
+    return list(instances.values())
 
-            product_attributes = product.get('attributes')
-            instance_type = product_attributes.get('instanceType')
 
-            if instance_type in ['u-6tb1', 'u-9tb1', 'u-12tb1']:
-                # API returns the name without the .metal suffix
-                instance_type = instance_type + '.metal'
+def add_instance(instances, offer_string, instance_types):
+    offer = _PARSER.parse(offer_string)
+    product = offer.get('product')
+    product_attributes = product.get('attributes', {})
+    instance_type = product_attributes.get('instanceType')
 
-            if instance_type in instances:
-                continue
+    if instance_type in ['u-6tb1', 'u-9tb1', 'u-12tb1']:
+        # API returns the name without the .metal suffix
+        instance_type = instance_type + '.metal'
 
-            new_inst = parse_instance(instance_type, product_attributes, instance_types.get(instance_type))
+    # The same instance type is listed once per OS/software combination,
+    # skip those we already have before looking any further into the offer
+    if instance_type in instances:
+        return
 
-            # Some instanced may be dedicated hosts instead
-            if new_inst is not None:
-                instances[instance_type] = new_inst
+    # Check if it's an instance
+    if product.get('productFamily') not in ['Compute Instance', 'Compute Instance (bare metal)', 'Dedicated Host']:
+        return
 
-    print(f"Found data for instance types: {', '.join(sorted(instances.keys()))}")
-    return list(instances.values())
+    # Lazy access is only used for the checks above, parse_instance gets plain
+    # Python objects so nothing it keeps can reference the parser's document
+    product_attributes = product_attributes.as_dict()
+    del offer, product
+
+    new_inst = parse_instance(instance_type, product_attributes, instance_types.get(instance_type))
+
+    # Some instanced may be dedicated hosts instead
+    if new_inst is not None:
+        instances[instance_type] = new_inst
 
 
 def add_pricing(imap):
@@ -123,59 +171,69 @@ def add_pricing(imap):
             {'Type': 'TERM_MATCH', 'Field': 'capacityStatus', 'Value': 'Used'},
             {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
             {'Type': 'TERM_MATCH', 'Field': 'licenseModel', 'Value': 'No License required'},
-            ])
+            ],
+        PaginationConfig={'PageSize': 100})
     for product_item in product_iterator:
         for offer_string in product_item.get('PriceList'):
-            offer = json.loads(offer_string)
-            product = offer.get('product')
-            product_attributes = product.get('attributes')
-            instance_type = product_attributes.get('instanceType')
-            location = canonicalize_location(product_attributes.get('location'))
-
-            # There may be a slight delay in updating botocore with new regional endpoints, skip and inform
-            if location not in descriptions:
-                print(f"WARNING: Ignoring pricing - unknown location. instance={instance_type}, location={location}")
-                continue
+            add_offer_pricing(imap, offer_string, descriptions)
+    add_spot_pricing(imap)
 
-            region = descriptions[location]
-            terms = offer.get('terms')
 
-            operating_system = product_attributes.get('operatingSystem')
-            preinstalled_software = product_attributes.get('preInstalledSw')
-            platform = translate_platform_name(operating_system, preinstalled_software)
+def add_offer_pricing(imap, offer_string, descriptions):
+    offer = _PARSER.parse(offer_string)
+    product = offer.get('product')
+    product_attributes = product.get('attributes')
+    instance_type = product_attributes.get('instanceType')
+    location = canonicalize_location(product_attributes.get('location'))
 
-            if instance_type not in imap:
-                print(f"WARNING: Ignoring pricing - unknown instance type. instance={instance_type}, location={location}")
-                continue
+    # There may be a slight delay in updating botocore with new regional endpoints, skip and inform
+    if location not in descriptions:
+        print(f"WARNING: Ignoring pricing - unknown location. instance={instance_type}, location={location}")
+        return
 
-            # If the instance type is not in us-east-1 imap[instance_type] could fail
-            try:
-                inst = imap[instance_type]
-                inst.pricing.setdefault(region, {})
-                inst.pricing[region].setdefault(platform, {})
-                inst.pricing[region][platform]['ondemand'] = get_ondemand_pricing(terms)
-                # Some instances don't offer reserved terms at all
-                reserved = get_reserved_pricing(terms)
-                if reserved:
-                    inst.pricing[region][platform]['reserved'] = reserved
-            except Exception as e:
-                # print more details about the instance for debugging
-                print(f"ERROR: Exception adding pricing for {instance_type}: {e}")
-                print(traceback.print_exc())
-    add_spot_pricing(imap)
+    region = descriptions[location]
+
+    operating_system = product_attributes.get('operatingSystem')
+    preinstalled_software = product_attributes.get('preInstalledSw')
+    platform = translate_platform_name(operating_system, preinstalled_software)
+
+    if instance_type not in imap:
+        print(f"WARNING: Ignoring pricing - unknown instance type. instance={instance_type}, location={location}")
+        return
+
+    # Only plain Python objects may be alive past this point. A logged exception
+    # keeps this frame and its callees around, and any proxy still referenced
+    # from them would stop _PARSER from parsing the next offer.
+    terms = offer['terms'].as_dict()
+    del offer, product, product_attributes
+
+    # If the instance type is not in us-east-1 imap[instance_type] could fail
+    try:
+        inst = imap[instance_type]
+        inst.pricing.setdefault(region, {})
+        inst.pricing[region].setdefault(platform, {})
+        inst.pricing[region][platform]['ondemand'] = get_ondemand_pricing(terms)
+        # Some instances don't offer reserved terms at all
+        reserved = get_reserved_pricing(terms)
+        if reserved:
+            inst.pricing[region][platform]['reserved'] = reserved
+    except Exception:
+        # log more details about the instance for debugging
+        log.exception("Exception adding pricing for %s", instance_type)
 
 def format_price(price):
-    return str(float("%f" % float(price))).rstrip('0').rstrip('.')
+    return ("%f" % float(price)).rstrip('0').rstrip('.')
 
 
 def get_ondemand_pricing(terms):
-    ondemand_terms = terms.get('OnDemand', {})
-    price = 0.0
     # There should be only one ondemand_term and one price_dimension
-    for ondemand_term in ondemand_terms.keys():
-        price_dimensions = ondemand_terms.get(ondemand_term).get('priceDimensions')
-        for price_dimension in price_dimensions.keys():
-            price = price_dimensions.get(price_dimension).get('pricePerUnit').get('USD')
+    ondemand_term = next(iter(terms.get('OnDemand', {}).values()), None)
+    if ondemand_term is None:
+        return 0.0
+    price_dimension = next(iter(ondemand_term['priceDimensions'].values()), None)
+    if price_dimension is None:
+        return 0.0
+    price = price_dimension['pricePerUnit'].get('USD')
     if not price:
         # print(f"WARNING: No USD price found")
         return 0.0
@@ -185,62 +243,92 @@ def get_ondemand_pricing(terms):
 def get_reserved_pricing(terms):
     pricing = {}
     reserved_terms = terms.get('Reserved', {})
-    for reserved_term in reserved_terms.keys():
-        term_attributes = reserved_terms.get(reserved_term).get('termAttributes')
-        price_dimensions = reserved_terms.get(reserved_term).get('priceDimensions')
+    for reserved_term in reserved_terms.values():
+        term_attributes = reserved_term['termAttributes']
+        price_dimensions = reserved_term['priceDimensions']
         # No Upfront instances don't have price dimension for upfront price
         upfront_price = 0.0
         price_per_hour = 0.0
-        for price_dimension in price_dimensions.keys():
-            temp_price = price_dimensions.get(price_dimension).get('pricePerUnit').get('USD')
+        for price_dimension in price_dimensions.values():
+            temp_price = price_dimension['pricePerUnit'].get('USD')
             if not temp_price:
                 # print(f"WARNING: No USD reserved price found")
                 continue
-            if price_dimensions.get(price_dimension).get('unit') == 'Hrs':
-                price_per_hour = temp_price
+            if price_dimension['unit'] == 'Hrs':
+                price_per_hour = float(temp_price)
             else:
-                upfront_price = temp_price
+                upfront_price = float(temp_price)
         local_term = translate_reserved_terms(term_attributes)
-        lease_in_years = term_attributes.get('LeaseContractLength')[0]
-        hours_in_term = int(lease_in_years[0]) * 365 * 24
-        price = float(price_per_hour) + (float(upfront_price)/hours_in_term)
+        # LeaseContractLength is given in form of "1yr" or "3yr"
+        lease = term_attributes['LeaseContractLength']
+        hours_in_term = int(lease[0]) * 365 * 24
+        price = price_per_hour + (upfront_price/hours_in_term)
         pricing[local_term] = format_price(price)
     return pricing
 
+# Number of instance types passed to a single describe_spot_price_history call
+SPOT_INSTANCE_TYPES_CHUNK = 100
+
+# Holds one boto3 Session per spot pricing worker thread
+_thread_local = threading.local()
+
+
 def add_spot_pricing(imap):
     instance_types = list(imap.keys())
-    # get a list of all available regions across all instance types
-    regions = []
-    for instance_type in instance_types:
-        regions += [r for r in imap[instance_type].pricing.keys()]
-    # deduplicate list of regions
-    regions = list(dict.fromkeys(regions))
-    for region in regions:
-        try:
-            # get all spot price data from a region
-            ec2_client = boto3.client('ec2', region_name=region)
-            prices_pager = ec2_client.get_paginator('describe_spot_price_history')
+    # get the set of all available regions across all instance types
+    regions = {r for inst in imap.values() for r in inst.pricing}
+    # keep the InstanceTypes filter of each request to a reasonable length
+    batches = [instance_types[i:i + SPOT_INSTANCE_TYPES_CHUNK]
+               for i in range(0, len(instance_types), SPOT_INSTANCE_TYPES_CHUNK)]
+    # spot price lookups are independent per region, fetch them concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = executor.map(lambda region: _fetch_region_spot(region, batches), regions)
+        # populate spot prices into the instance data from this thread only
+        for region_prices in results:
+            for region, instance_type, platform, spot_price in region_prices:
+                inst = imap[instance_type]
+                inst.pricing[region].setdefault(platform,{})
+                inst.pricing[region][platform].setdefault('spot',[]).append(spot_price)
+    # sort each spot price list once, rather than on every append, and derive min/max from it
+    for inst in imap.values():
+        for region_pricing in inst.pricing.values():
+            for platform_pricing in region_pricing.values():
+                if 'spot' in platform_pricing:
+                    platform_pricing['spot'].sort(key=float)
+                    platform_pricing['spot_min'] = platform_pricing['spot'][0]
+                    platform_pricing['spot_max'] = platform_pricing['spot'][-1]
+
+
+def _thread_session():
+    """Return the boto3 Session owned by the calling thread.
+
+    boto3's default session is not thread-safe, and creating a Session per call
+    would reload the service models every time.
+    """
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = boto3.Session()
+    return _thread_local.session
+
+
+def _fetch_region_spot(region, batches):
+    """Return (region, instance_type, platform, price) tuples for all current spot prices in a region"""
+    result = []
+    try:
+        # get all spot price data from a region, one client serves every batch
+        ec2_client = _thread_session().client('ec2', region_name=region)
+        prices_pager = ec2_client.get_paginator('describe_spot_price_history')
+        for instance_types in batches:
             prices_iterator = prices_pager.paginate(
                 InstanceTypes=instance_types,
-                StartTime=datetime.now())
-            # populate spot prices into the instance data
+                StartTime=datetime.now(),
+                PaginationConfig={'PageSize': 1000})
             for p in prices_iterator:
-                prices = p['SpotPriceHistory']
-                for price in prices:
-                    inst = imap[price['InstanceType']]
+                for price in p['SpotPriceHistory']:
                     platform = translate_platform_name(price['ProductDescription'], 'NA')
-                    region = price['AvailabilityZone'][0:-1]
-                    # define some empty/meaningful default values to avoid dictionary exception for missing instance types
-                    inst.pricing[region].setdefault(platform,{})
-                    inst.pricing[region][platform].setdefault('spot',[])
-                    inst.pricing[region][platform].setdefault('spot_min','N/A')
-                    inst.pricing[region][platform].setdefault('spot_max','N/A')
-                    inst.pricing[region][platform]['spot'].append(price['SpotPrice'])
-                    inst.pricing[region][platform]['spot'].sort(key=float)
-                    inst.pricing[region][platform]['spot_min'] = inst.pricing[region][platform]['spot'][0]
-                    inst.pricing[region][platform]['spot_max'] = inst.pricing[region][platform]['spot'][-1]
-        except botocore.exceptions.ClientError:
-            pass
+                    result.append((price['AvailabilityZone'][0:-1], price['InstanceType'], platform, price['SpotPrice']))
+    except botocore.exceptions.ClientError:
+        pass
+    return result
 
 def parse_instance(instance_type, product_attributes, api_description):
     pieces = instance_type.split('.')
@@ -255,10 +343,10 @@ def parse_instance(instance_type, product_attributes, api_description):
 
     i.family = product_attributes.get('instanceFamily')
 
-    i.vCPU = locale.atoi(product_attributes.get('vcpu'))
+    i.vCPU = int(product_attributes['vcpu'].replace(',', ''))
 
     # Memory is given in form of "1,952 GiB", let's parse it
-    i.memory = locale.atof(product_attributes.get('memory').split(' ')[0])
+    i.memory = float(product_attributes['memory'].split(' ')[0].replace(',', ''))
 
     if api_description:
         i.arch = api_description['ProcessorInfo']['SupportedArchitectures']
@@ -279,7 +367,7 @@ def parse_instance(instance_type, product_attributes, api_description):
 
     gpu = product_attributes.get('gpu')
     if gpu is not None:
-        i.GPU = locale.atoi(gpu)
+        i.GPU = int(gpu.replace(',', ''))
 
     if api_description:
         if 'FpgaInfo' in api_description:
@@ -298,7 +386,7 @@ def parse_instance(instance_type, product_attributes, api_description):
         if ecu == 'Variable':
             i.ECU = 'variable'
         else:
-            i.ECU = locale.atof(ecu)
+            i.ECU = float(ecu.replace(',', ''))
     except:
         pass
 